@@ -5,14 +5,17 @@ Fetches valid NHTSA codes and saves them to an Excel file
 with each field type as a column and its valid codes as dropdown values.
 """
 
-import requests
+from itertools import zip_longest
 from pathlib import Path
 from datetime import datetime
 from openpyxl import Workbook
 
+from nhtsa_api import get_nhtsa_data
+
 # ========= CONFIG =========
 NHTSA_URL = "https://nrd.api.nhtsa.dot.gov/nhtsa/nhtsadb/api/v1/ncodes"
 OUTPUT_PATH = Path(r"C:\\Github\\UVACAB\\DataTapeValidation\\Data\\Processed")
+NHTSA_CACHE_PATH = OUTPUT_PATH / "nhtsa_cache.json"   # Last NHTSA API response body
 
 
 def fetch_valid_codes(url=NHTSA_URL):
@@ -21,9 +24,7 @@ def fetch_valid_codes(url=NHTSA_URL):
     Returns a dictionary {field_type: set(codes)}.
     """
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        data = get_nhtsa_data(url, NHTSA_CACHE_PATH)
     except Exception as e:
         print(f"Error fetching API data: {e}")
         return {}
@@ -48,22 +49,18 @@ def save_valid_codes_excel(valid_codes, output_dir):
     timestamp = datetime.now().strftime("%Y%m%d")
     output_file = output_dir / f"valid_codes_{timestamp}.xlsx"
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "ValidCodes"
+    # Write-only mode streams rows to disk instead of keeping Cell objects
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("ValidCodes")
 
     fields = sorted(valid_codes.keys())
     ws.append(fields)
 
-    # Determine max list length to fill rows correctly
-    max_len = max(len(codes) for codes in valid_codes.values())
-
-    for i in range(max_len):
-        row = []
-        for field in fields:
-            codes = sorted(valid_codes[field])
-            row.append(codes[i] if i < len(codes) else "")
-        ws.append(row)
+    # Sort each field's codes once, then transpose the columns into rows;
+    # shorter columns are padded with empty cells
+    sorted_columns = [sorted(valid_codes[field]) for field in fields]
+    for row in zip_longest(*sorted_columns, fillvalue=""):
+        ws.append(list(row))
 
     wb.save(output_file)
     print(f"Saved valid codes Excel file to {output_file}")
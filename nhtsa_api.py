@@ -0,0 +1,107 @@
+"""
+nhtsa_api.py
+
+Shared NHTSA API access for validate.py and create_valid_codes_excel.py:
+a pooled HTTP session with retries, JSON decoding, and an on-disk
+conditional-GET cache of the API response.
+"""
+
+import json
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # optional, faster JSON decoding
+except ImportError:
+    orjson = None
+
+# Shared HTTP session: reuses connections and retries transient server errors
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+))
+
+
+def _parse_json(content):
+    """Decode a JSON response body, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def _write_atomic(path, data):
+    """Write bytes to a temp file next to path, then move it into place."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    try:
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def _clear_cache(cache_path, headers_path):
+    """Delete the cached response and its validators sidecar."""
+    for path in (cache_path, headers_path):
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+
+def get_nhtsa_data(url, cache_path):
+    """
+    GET the NHTSA API and return the decoded JSON.
+    The response body is cached at cache_path together with its
+    ETag/Last-Modified, and a 304 Not Modified reply reuses the cached body.
+    An unreadable or corrupt cache is discarded and the API is queried
+    unconditionally.
+    """
+    headers_path = cache_path.with_suffix(".headers.json")
+    request_headers = {}
+    if cache_path.exists() and headers_path.exists():
+        try:
+            cached = json.loads(headers_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            cached = None
+        if not isinstance(cached, dict):
+            # Unreadable, or valid JSON of the wrong shape (e.g. a list)
+            _clear_cache(cache_path, headers_path)
+            cached = {}
+        if cached.get("url") == url:
+            etag = cached.get("etag")
+            last_modified = cached.get("last_modified")
+            if etag and isinstance(etag, str):
+                request_headers["If-None-Match"] = etag
+            if last_modified and isinstance(last_modified, str):
+                request_headers["If-Modified-Since"] = last_modified
+
+    response = _SESSION.get(url, timeout=10, headers=request_headers)
+    if response.status_code == 304:
+        try:
+            return _parse_json(cache_path.read_bytes())
+        except (OSError, ValueError):
+            print("Cached NHTSA response is unreadable, fetching it again.")
+            _clear_cache(cache_path, headers_path)
+            response = _SESSION.get(url, timeout=10)
+    response.raise_for_status()
+    data = _parse_json(response.content)
+
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if etag or last_modified:
+        # Body first, sidecar last, so validators never point at a partial body
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            _write_atomic(cache_path, response.content)
+            _write_atomic(headers_path, json.dumps({
+                "url": url,
+                "etag": etag,
+                "last_modified": last_modified
+            }).encode("utf-8"))
+        except OSError as e:
+            print(f"Could not update NHTSA cache: {e}")
+    return data
@@ -2,77 +2,84 @@ import requests
 import csv
 import json
 import re
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from operator import itemgetter
 from pathlib import Path
 from datetime import datetime
 
+from nhtsa_api import get_nhtsa_data
+
 # ========= CONFIG =========
 BASE_PATH = Path(__file__).resolve().parent         # Resolve the parent directory of the scripts
 DATA_PATH = BASE_PATH / "Data"                      # Input folder path
 OUTPUT_PATH = DATA_PATH / "ProcessedFiles"          # Output path
 SCHEMA_PATH = BASE_PATH / "schema.json"             # Schema file path
+NHTSA_CACHE_PATH = OUTPUT_PATH / "nhtsa_cache.json" # Last NHTSA API response body
 NHTSA_URL = "https://nrd.api.nhtsa.dot.gov/nhtsa/nhtsadb/api/v1/ncodes"
 VALIDATE_FIELD_TYPES = False    # validate that field_type exists in valid_codes
 VALIDATE_CODES = True           # validate that value is an allowed code
+WRITE_BUFFER_SIZE = 1 << 20     # buffer size (bytes) for CSV report writes
 
 
 # ========= FUNCTIONS =========
 
 def fetch_valid_codes(url=NHTSA_URL):
-    """Fetch valid codes from the NHTSA API and return a list of dicts."""
+    """
+    Fetch valid codes from the NHTSA API, validating the response on the way.
+    Returns (True, list of dicts) on success, or (False, error message).
+    """
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-    except Exception as e:
-        print(f"Error fetching API data: {e}")
-        return []
-
-    results = data.get("results", [])
-    if not results:
-        print("No results returned from API.")
-        return []
+        data = get_nhtsa_data(url, NHTSA_CACHE_PATH)
+    except requests.exceptions.RequestException as e:
+        return False, f"API request failed: {e}"
+    except ValueError:
+        return False, "Response is not valid JSON."
+
+    if "results" not in data or not isinstance(data["results"], list):
+        return False, "Unexpected JSON structure (missing 'results')."
+
+    results = data["results"]
+    sample = results[0] if results else None
+    if not sample or "code" not in sample:
+        return False, "No 'code' field found in API response."
 
     # Save valid codes to a timestamped CSV
     OUTPUT_PATH.mkdir(parents=True, exist_ok=True)
     timestamp = datetime.now().strftime("%Y%m%d")
     output_file = OUTPUT_PATH / f"valid_codes_{timestamp}.csv"
 
-    with output_file.open("w", newline="", encoding="utf-8") as csvfile:
+    with output_file.open("w", newline="", encoding="utf-8",
+                          buffering=WRITE_BUFFER_SIZE) as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow(["CodeName", "Code", "Description"])
-        for item in sorted(results, key=lambda x: (x.get("codeName", ""), x.get("code", ""))):
-            writer.writerow([
+        writer.writerows(
+            [
                 item.get("codeName", "").strip(),
                 item.get("code", "").strip().upper(),
                 item.get("description", "").strip()
-            ])
+            ]
+            for item in sorted(results, key=lambda x: (x.get("codeName", ""), x.get("code", "")))
+        )
 
     print(f"Loaded {len(results)} valid codes from NHTSA API.")
     print(f"Saved valid codes to {output_file.name}")
-    return results
-
+    return True, results
 
-def validate_nhtsa_api(url):
-    """Validate the NHTSA API endpoint before using it."""
-    try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        return False, f"API request failed: {e}"
 
-    try:
-        data = response.json()
-    except ValueError:
-        return False, "Response is not valid JSON."
-
-    if "results" not in data or not isinstance(data["results"], list):
-        return False, "Unexpected JSON structure (missing 'results')."
-
-    sample = data["results"][0] if data["results"] else None
-    if not sample or "code" not in sample:
-        return False, "No 'code' field found in API response."
-
-    return True, data
+def build_valid_lookup(valid_codes):
+    """
+    Return {code_name: frozenset(codes)} from the NHTSA result dicts.
+    Codes are UTF-8 encoded bytes to match the values read from EV5 files.
+    """
+    valid_lookup = {}
+    for v in valid_codes:
+        name = v.get("codeName", "").strip().upper()
+        code = v.get("code", "").strip().upper()
+        if name and code:
+            valid_lookup.setdefault(name, set()).add(code.encode("utf-8"))
+    return {name: frozenset(codes) for name, codes in valid_lookup.items()}
 
 
 def load_schema(schema_path):
@@ -84,156 +91,265 @@ def load_schema(schema_path):
         return json.load(f)
 
 
+_HEADER_RE = re.compile(rb"^-{2,}\s*([A-Z ]+)\s*-{2,}$")
+
+# The ASCII characters str.strip() removes (bytes.strip() skips \x1c-\x1f)
+_ASCII_WHITESPACE = b" \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f"
+
+
 def parse_ev5_blocks(ev5_path):
-    """Return {block_name: [lines]} from an EV5 file."""
+    """
+    Return {block_name: [lines]} from an EV5 file.
+    Lines are kept as bytes. Non-ASCII lines are normalized to valid UTF-8
+    the same way text-mode reading with errors="ignore" would.
+    """
     blocks = {}
     current_block = None
-    with ev5_path.open("r", encoding="utf-8", errors="ignore") as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
+    # Read the whole file at once; bytes.splitlines breaks on the same
+    # "\n", "\r" and "\r\n" endings that text-mode iteration does
+    data = ev5_path.read_bytes()
+    for line in data.splitlines():
+        if line.isascii():
+            line = line.strip(_ASCII_WHITESPACE)
+        else:
+            line = line.decode("utf-8", errors="ignore").strip().encode("utf-8")
+        if not line or line.startswith(b"#"):
+            continue
 
-            header_match = re.match(r"^-{2,}\s*([A-Z ]+)\s*-{2,}$", line)
-            if header_match:
-                current_block = header_match.group(1).strip().upper()
-                blocks[current_block] = []
-                continue
+        # Block headers always start with dashes; skip the regex for data lines
+        header_match = line.startswith(b"-") and _HEADER_RE.match(line)
+        if header_match:
+            current_block = header_match.group(1).strip().decode("ascii")
+            blocks[current_block] = []
+            continue
 
-            if current_block:
-                blocks[current_block].append(line)
+        if current_block:
+            blocks[current_block].append(line)
     return blocks
 
 
-def validate_ev5_blocks(ev5_path, schema, valid_codes,
+# Column order of the invalid-entry tuples and of the CSV report
+REPORT_FIELDS = (
+    "Block", "Line", "Column", "Field", "Value",
+    "InvalidType", "ExpectedCodes", "Status"
+)
+
+
+def validate_ev5_blocks(ev5_path, schema, valid_lookup,
                         validate_field_types=VALIDATE_FIELD_TYPES,
                         validate_codes=VALIDATE_CODES):
+    """Return (checked_count, invalid_entries); entries are tuples in REPORT_FIELDS order."""
 
     blocks = parse_ev5_blocks(ev5_path)
     invalid_entries = []
     checked_count = 0
 
-    # Build lookups
-    valid_lookup = {}
-    for v in valid_codes:
-        name = v.get("codeName", "").strip().upper()
-        code = v.get("code", "").strip().upper()
-        if name and code:
-            valid_lookup.setdefault(name, set()).add(code)
+    # Resolve field names and column indexes once, outside the row loop
+    schema_prepared = {
+        blk.upper(): [
+            (field_type, field_type.strip().upper(), col, int(col) - 1)
+            for field_type, col in cols.items()
+        ]
+        for blk, cols in schema.items()
+    }
+    expected_cache = {}
 
     for block, rows in blocks.items():
-        if block.upper() not in schema:
+        # Blocks without schema fields (e.g. ANTHROPOMETRY) need no splitting
+        fields = schema_prepared.get(block.upper())
+        if not fields:
             continue
 
-        for line_num, row in enumerate(rows, start=1):
-            parts = row.split("|")
-
-            for field_type, col in schema[block].items():
-                idx = int(col) - 1
-                if idx >= len(parts):
-                    continue
-
-                value = parts[idx].strip().upper()
-                if not value:
-                    continue
-
-                checked_count += 1
-                field_type_upper = field_type.strip().upper()
-
-                # FIELD validation
-                if validate_field_types:
-                    if field_type_upper not in valid_lookup:
-                        invalid_entries.append({
-                            "Block": block,
-                            "Field": field_type,
-                            "Value": value,
-                            "Line": line_num,
-                            "Column": col,
-                            "ExpectedCodes": "Field type not recognized",
-                            "InvalidType": "FIELD",
-                            "Status": "INVALID"
-                        })
-                        # Skip code validation if field invalid
-                        continue
-
-                # CODE validation
-                if validate_codes:
-                    if field_type_upper in valid_lookup:
-                        if value not in valid_lookup[field_type_upper]:
-                            expected = ", ".join(sorted(valid_lookup[field_type_upper]))
-                            invalid_entries.append({
-                                "Block": block,
-                                "Field": field_type,
-                                "Value": value,
-                                "Line": line_num,
-                                "Column": col,
-                                "ExpectedCodes": expected,
-                                "InvalidType": "CODE",
-                                "Status": "INVALID"
-                            })
+        parts_matrix = [row.split(b"|") for row in rows]
+        block_invalid = []
+
+        # Validate column by column: collect a field's values across all rows,
+        # then find the invalid ones with a single set difference
+        for field_type, field_type_upper, col, idx in fields:
+            # Allowed codes are constant for the whole column; look them up once
+            allowed = valid_lookup.get(field_type_upper)
+
+            # values[i] belongs to line i + 1; b"" marks a missing or empty cell
+            values = [
+                parts[idx].strip(_ASCII_WHITESPACE).upper() if idx < len(parts) else b""
+                for parts in parts_matrix
+            ]
+            distinct = set(values)
+
+            # Bytes strip/upper only match str rules for ASCII. Re-normalize the
+            # (rare) distinct non-ASCII values with Unicode strip/upper, e.g. so
+            # a trailing NBSP or a lower-case "é" compares like the text would
+            non_ascii = {
+                v: v.decode("utf-8").strip().upper().encode("utf-8")
+                for v in distinct if not v.isascii()
+            }
+            if non_ascii:
+                values = [non_ascii.get(v, v) for v in values]
+                distinct = set(values)
+
+            distinct.discard(b"")
+            checked_count += len(values) - values.count(b"")
+
+            # FIELD validation (skips code validation if field invalid)
+            if validate_field_types and allowed is None:
+                invalid_values = distinct
+                invalid_type = "FIELD"
+
+            # CODE validation
+            elif validate_codes and allowed is not None:
+                invalid_values = distinct - allowed
+                invalid_type = "CODE"
+
+            else:
+                continue
+
+            if not invalid_values:
+                continue
+
+            if invalid_type == "FIELD":
+                expected = "Field type not recognized"
+            else:
+                expected = expected_cache.get(field_type_upper)
+                if expected is None:
+                    expected = b", ".join(sorted(allowed)).decode("utf-8")
+                    expected_cache[field_type_upper] = expected
+
+            # Only revisit rows for the (usually few) distinct invalid values,
+            # decoding each of those values once for the report
+            decoded = {v: v.decode("utf-8") for v in invalid_values}
+            block_invalid.extend(
+                (block, line_num, col, field_type, decoded[value],
+                 invalid_type, expected, "INVALID")
+                for line_num, value in enumerate(values, start=1)
+                if value in decoded
+            )
+
+        # Report in row order, keeping schema field order within a row
+        # (the sort is stable)
+        block_invalid.sort(key=itemgetter(1))
+        invalid_entries.extend(block_invalid)
 
     return checked_count, invalid_entries
 
 
+_CSV_NEEDS_QUOTES = re.compile(r'[,"\r\n]')
+
+
+def _csv_field(value):
+    """Quote a CSV field the same way csv.writer does (QUOTE_MINIMAL)."""
+    value = str(value)
+    if _CSV_NEEDS_QUOTES.search(value):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
 def write_combined_report(ev5_path, invalid_entries):
     """Write invalid field report to CSV with line, column, and invalid type."""
     OUTPUT_PATH.mkdir(parents=True, exist_ok=True)
     output_csv = OUTPUT_PATH / f"{ev5_path.stem}_schema_validated.csv"
 
-    with output_csv.open("w", newline="", encoding="utf-8") as csvfile:
-        fieldnames = [
-            "Block", "Line", "Column", "Field", "Value", 
-            "InvalidType", "ExpectedCodes", "Status"
-        ]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for e in invalid_entries:
-            writer.writerow(e)
+    # The report layout is fixed, so rows are formatted directly rather than
+    # through csv.writer
+    lines = [",".join(REPORT_FIELDS) + "\r\n"]
 
-    print(f"  Schema validation results written to {output_csv.name}")
+    # Every invalid value of a field shares the same (long) ExpectedCodes
+    # string, so quote each distinct one only once
+    quoted_expected = {}
+    for e in invalid_entries:
+        expected = e[6]
+        quoted = quoted_expected.get(expected)
+        if quoted is None:
+            quoted = quoted_expected[expected] = _csv_field(expected)
+        lines.append(
+            ",".join(map(_csv_field, e[:6])) + "," + quoted + ","
+            + _csv_field(e[7]) + "\r\n"
+        )
 
+    with output_csv.open("w", newline="", encoding="utf-8",
+                         buffering=WRITE_BUFFER_SIZE) as csvfile:
+        csvfile.write("".join(lines))
+
+    return output_csv
+
+
+def _process_one(ev5_path, schema, valid_lookup):
+    """Validate a single EV5 file and write its report (runs in a worker process)."""
+    checked, invalid = validate_ev5_blocks(ev5_path, schema, valid_lookup)
+    output_csv = write_combined_report(ev5_path, invalid) if invalid else None
+    # Only the preview rows are sent back to the parent process
+    return checked, len(invalid), invalid[:10], output_csv
 
 
 def main():
     """Main workflow: validate the API, then process EV5 files."""
     print("Validating NHTSA API...")
 
-    ok, result = validate_nhtsa_api(NHTSA_URL)
+    # A single request both validates the API and fetches the codes; it runs
+    # in the background while the schema is loaded and EV5 files are found.
+    # Nothing is printed from this thread meanwhile: a missing schema is only
+    # reported (by load_schema) after the API result, as before.
+    with ThreadPoolExecutor(max_workers=1) as io_executor:
+        codes_future = io_executor.submit(fetch_valid_codes, NHTSA_URL)
+        schema = load_schema(SCHEMA_PATH) if SCHEMA_PATH.exists() else None
+        ev5_files = list(DATA_PATH.rglob("*.ev5"))
+        ok, result = codes_future.result()
+
     if not ok:
         print(f"API validation failed: {result}")
         return
     else:
         print("NHTSA API is reachable and valid.")
 
-    valid_codes = fetch_valid_codes()
-    if not valid_codes:
-        return
+    # Built once and shared read-only with every worker
+    valid_lookup = build_valid_lookup(result)
 
-    schema = load_schema(SCHEMA_PATH)
+    if schema is None:
+        schema = load_schema(SCHEMA_PATH)
     if not schema:
         print("Schema not loaded, exiting.")
         return
 
-    ev5_files = list(DATA_PATH.rglob("*.ev5"))
     if not ev5_files:
         print(f"No .ev5 files found in {DATA_PATH}")
         return
 
     print(f"Found {len(ev5_files)} .ev5 files to validate.")
 
-    for ev5_path in ev5_files:
-        print(f"\nProcessing {ev5_path.name}...")
-        checked, invalid = validate_ev5_blocks(ev5_path, schema, valid_codes)
-        print(f"  Checked {checked} coded fields.")
-        print(f"  Invalid entries: {len(invalid)}")
-        if invalid:
-            for e in invalid[:10]:
-                print(f"    {e['Block']}.{e['Field']} = {e['Value']}")
-            if len(invalid) > 10:
-                print(f"    ...and {len(invalid)-10} more.")
-            write_combined_report(ev5_path, invalid)
-        else:
-            print("  All coded fields valid.")
+    # Each file is independent, so validate them concurrently
+    failed = []
+    with ProcessPoolExecutor() as executor:
+        futures = {
+            executor.submit(_process_one, ev5_path, schema, valid_lookup): ev5_path
+            for ev5_path in ev5_files
+        }
+        for future in as_completed(futures):
+            ev5_path = futures[future]
+            print(f"\nProcessing {ev5_path.name}...")
+            try:
+                checked, invalid_count, preview, output_csv = future.result()
+            except Exception as e:
+                # Keep going so the other files still get reported, but show the
+                # full (worker) traceback and fail the run once all are done
+                print(f"  Error processing file: {type(e).__name__}: {e}")
+                traceback.print_exception(type(e), e, e.__traceback__)
+                failed.append(ev5_path)
+                continue
+            print(f"  Checked {checked} coded fields.")
+            print(f"  Invalid entries: {invalid_count}")
+            if invalid_count:
+                for e in preview:
+                    print(f"    {e[0]}.{e[3]} = {e[4]}")
+                if invalid_count > 10:
+                    print(f"    ...and {invalid_count-10} more.")
+                print(f"  Schema validation results written to {output_csv.name}")
+            else:
+                print("  All coded fields valid.")
+
+    if failed:
+        print(f"\n{len(failed)} file(s) failed to process:")
+        for ev5_path in failed:
+            print(f"  {ev5_path}")
+        sys.exit(1)
 
 
 if __name__ == "__main__":